@@ -1,106 +1,342 @@
+import asyncio
 import socket
+import sys
 import threading
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
-import stun  # Requires a STUN client library such as pystun3
+import struct
 import json
 import os
-from datetime import datetime
+import random
+import selectors
+from urllib.parse import quote
+from collections import Counter
+
+import mmsg
 
 # Load configuration
 config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'config', 'chat_config.json')
 with open(config_path) as f:
     config = json.load(f)
 
-# Build server URL with proper protocol
-SERVER_URL = f"{'https' if config['server']['use_https'] else 'http'}://{config['server']['host']}"
-if (not config['server']['use_https'] and config['server']['port'] != 80) or \
-   (config['server']['use_https'] and config['server']['port'] != 443):
-    SERVER_URL += f":{config['server']['port']}"
+# Read once at import; these are consulted on every keep-alive and punch wake-up
+KEEPALIVE_INTERVAL = float(config['client']['keepalive_interval'])
+PUNCH_TIMEOUT = float(config['client']['punch_timeout'])
+CGNAT_MODE = bool(config['client'].get('cgnat_mode', False))
+STUN_SERVERS = [(s['host'], int(s['port'])) for s in config['stun']['servers']]
+STUN_TIMEOUT = float(config['stun'].get('timeout', 1.0))
+
+# Peer endpoints returned by the rendezvous server are cached next to the config
+PEER_CACHE_PATH = os.path.join(os.path.dirname(config_path), 'peer_cache.json')
+PEER_CACHE_TTL = 3600  # seconds
+
+REFRESH_IN = 240  # seconds between registrations unless the server advises otherwise
+
+PUNCH_BURST = 5  # PUNCH packets sent back-to-back per burst
+
+# Control tokens exchanged on the P2P socket, compared as raw bytes
+KEEPALIVE = b'KEEPALIVE'
+PUNCH = b'PUNCH'
+ACK = b'ACK'
+CONTROL_TOKENS = frozenset((KEEPALIVE, PUNCH, ACK))
+
+RECV_BUFFER_SIZE = 4 * 1024 * 1024
+SEND_BUFFER_SIZE = 2 * 1024 * 1024
+
+# STUN (RFC 5389) message constants
+STUN_MAGIC_COOKIE = 0x2112A442
+STUN_BINDING_REQUEST = 0x0001
+STUN_BINDING_SUCCESS = 0x0101
+STUN_ATTR_MAPPED_ADDRESS = 0x0001
+STUN_ATTR_XOR_MAPPED_ADDRESS = 0x0020
+_STUN_COOKIE_BYTES = STUN_MAGIC_COOKIE.to_bytes(4, 'big')
+
+# Build server URL with proper protocol, leaving out the scheme's default port
+_scheme, _default_port = ('https', 443) if config['server']['use_https'] else ('http', 80)
+SERVER_URL = f"{_scheme}://{config['server']['host']}" + (
+    '' if config['server']['port'] == _default_port else f":{config['server']['port']}"
+)
+REGISTER_URL = f"{SERVER_URL}/register"
+
+# Resolved once so falling back after a STUN failure doesn't block on DNS
+try:
+    _LOCAL_IP = socket.gethostbyname(socket.gethostname())
+except OSError:
+    _LOCAL_IP = '127.0.0.1'
+
+# Reuse one keep-alive connection to the rendezvous server instead of a new TLS handshake per call
+_SESSION = requests.Session()
+_SESSION.headers.update({'Connection': 'keep-alive'})
+# Let urllib3 absorb brief gateway errors (e.g. the host waking up) on the pooled
+# connection. Connection and read errors are left to the callers' own backoff so
+# the two layers never retry the same failure.
+GATEWAY_ERRORS = (502, 503, 504)
+_SESSION.mount(SERVER_URL, HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(
+        total=3,
+        connect=0,
+        read=0,
+        other=0,
+        backoff_factor=1.0,
+        backoff_jitter=1.0,
+        status_forcelist=GATEWAY_ERRORS,
+        allowed_methods=['GET', 'POST'],
+        raise_on_status=False
+    )
+))
+
+def receive_until(udp_socket, timeout, handle):
+    """Pass datagrams arriving within timeout seconds to handle(data, addr) until it returns True"""
+    deadline = time.monotonic() + timeout
+    udp_socket.setblocking(False)
+    # DefaultSelector is epoll/kqueue where available and falls back to poll/select elsewhere
+    with selectors.DefaultSelector() as sel:
+        sel.register(udp_socket, selectors.EVENT_READ)
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not sel.select(remaining):
+                    return False
+                # Drain everything already queued before waiting again
+                while True:
+                    try:
+                        data, addr = udp_socket.recvfrom(2048)
+                    except BlockingIOError:
+                        break
+                    except ConnectionError:
+                        continue  # Windows reports ICMP port-unreachable as a reset
+                    if handle(data, addr):
+                        return True
+        finally:
+            udp_socket.setblocking(True)
+
+def build_stun_request():
+    """Build a STUN Binding Request, returning (packet, transaction_id)"""
+    transaction_id = os.urandom(12)
+    header = struct.pack('!HHI', STUN_BINDING_REQUEST, 0, STUN_MAGIC_COOKIE)
+    return header + transaction_id, transaction_id
 
-def get_public_endpoint():
-    """Get public endpoint using multiple STUN servers"""
+def parse_stun_response(data):
+    """Return (transaction_id, (ip, port)) from a Binding success response, or None"""
+    if len(data) < 20:
+        return None
+    msg_type, msg_len = struct.unpack_from('!HH', data)
+    if msg_type != STUN_BINDING_SUCCESS:
+        return None
+    
+    mapped = None
+    pos, end = 20, min(len(data), 20 + msg_len)
+    while pos + 4 <= end:
+        attr_type, attr_len = struct.unpack_from('!HH', data, pos)
+        if pos + 4 + attr_len > end:
+            break  # Attribute runs past the end of the message
+        value = data[pos + 4:pos + 4 + attr_len]
+        # Only IPv4 (family 0x01) mappings are useful for our AF_INET socket
+        if attr_type in (STUN_ATTR_XOR_MAPPED_ADDRESS, STUN_ATTR_MAPPED_ADDRESS) \
+                and len(value) >= 8 and value[1] == 0x01:
+            port = struct.unpack_from('!H', value, 2)[0]
+            ip = value[4:8]
+            if attr_type == STUN_ATTR_XOR_MAPPED_ADDRESS:
+                port ^= STUN_MAGIC_COOKIE >> 16
+                ip = bytes(b ^ m for b, m in zip(ip, _STUN_COOKIE_BYTES))
+                return data[8:20], (socket.inet_ntoa(ip), port)
+            # Pre-RFC 5389 servers only send MAPPED-ADDRESS; keep looking for the XOR form
+            mapped = (socket.inet_ntoa(ip), port)
+        pos += 4 + attr_len + (-attr_len % 4)  # Attributes are padded to 4 bytes
+    
+    return (data[8:20], mapped) if mapped else None
+
+def get_public_endpoint(udp_socket, log=print):
+    """Get public endpoint by sending Binding Requests to all STUN servers from udp_socket
+
+    Progress lines go to log, so callers can hold them back while prompting the user.
+    """
+    servers = STUN_SERVERS
+    quorum = (len(servers) + 1) // 2
     results = []
+    ip_votes = Counter()
     
-    for stun_server in config['stun']['servers']:
+    # Fire every request at once from the socket we will chat on, so the mapping we
+    # discover is the one our peer needs to reach
+    pending = {}
+    log(f"\nQuerying {len(servers)} STUN servers...")
+    for stun_server in servers:
+        packet, transaction_id = build_stun_request()
         try:
-            print(f"\nTrying STUN server: {stun_server['host']}:{stun_server['port']}")
-            nat_type, external_ip, external_port = stun.get_ip_info(
-                stun_host=stun_server['host'],
-                stun_port=stun_server['port']
-            )
-            if external_ip and external_port:
-                results.append({
-                    'nat_type': nat_type,
-                    'ip': external_ip,
-                    'port': external_port,
-                    'server': stun_server['host']
-                })
-                print(f"✓ Success: {nat_type} NAT, endpoint: {external_ip}:{external_port}")
-            else:
-                print(f"✗ Failed: No endpoint received")
-        except Exception as e:
-            print(f"✗ Error with {stun_server['host']}: {e}")
+            udp_socket.sendto(packet, stun_server)
+            pending[transaction_id] = stun_server
+        except OSError as e:
+            log(f"✗ Error with {stun_server[0]}: {e}")
     
-    if not results:
-        print("\n⚠️ All STUN servers failed. Falling back to local IP")
-        local_ip = socket.gethostbyname(socket.gethostname())
-        return local_ip, 0, "Unknown"
+    def handle_reply(data, addr):
+        parsed = parse_stun_response(data)
+        if not parsed or parsed[0] not in pending:
+            return False  # Not a reply to one of our requests
+        stun_server = pending.pop(parsed[0])
+        external_ip, external_port = parsed[1]
+        results.append({
+            'ip': external_ip,
+            'port': external_port,
+            'server': stun_server[0]
+        })
+        ip_votes[external_ip] += 1
+        log(f"✓ {stun_server[0]}: endpoint {external_ip}:{external_port}")
+        # Stop once a majority agrees, no need to wait for the slower servers
+        return not pending or ip_votes[external_ip] >= quorum
     
-    # Analyze results
-    nat_types = set(r['nat_type'] for r in results)
-    ips = set(r['ip'] for r in results)
+    if pending and not receive_until(udp_socket, STUN_TIMEOUT, handle_reply):
+        log(f"✗ No response from: {', '.join(host for host, _ in pending.values())}")
     
-    print("\nNAT Analysis:")
-    print(f"Detected NAT types: {', '.join(nat_types)}")
-    print(f"Detected IPs: {', '.join(ips)}")
+    if not results:
+        log("\n⚠️ All STUN servers failed. Falling back to local IP")
+        return _LOCAL_IP, 0, "Unknown"
     
     # Use the most common result
-    from collections import Counter
-    ip_counter = Counter(r['ip'] for r in results)
-    most_common_ip = ip_counter.most_common(1)[0][0]
+    most_common_ip = ip_votes.most_common(1)[0][0]
+    ports = set(r['port'] for r in results if r['ip'] == most_common_ip)
+    
+    # Same local socket seen through different servers tells us how the NAT maps it
+    local_port = udp_socket.getsockname()[1]
+    if len(ports) > 1:
+        nat_type = "Symmetric"
+    elif local_port in ports:
+        nat_type = "Port-preserving Cone"
+    else:
+        nat_type = "Cone"
+    
+    log("\nNAT Analysis:")
+    log(f"Detected NAT type: {nat_type}")
+    log(f"Detected IPs: {', '.join(ip_votes)}")
     
     # Find the corresponding port for the most common IP
     for r in results:
         if r['ip'] == most_common_ip:
-            print(f"\nSelected endpoint: {r['ip']}:{r['port']} (NAT: {r['nat_type']})")
-            return r['ip'], r['port'], r['nat_type']
-    
-    # Fallback to first result if no common IP found
-    print(f"\nFalling back to first valid result")
-    return results[0]['ip'], results[0]['port'], results[0]['nat_type']
+            log(f"\nSelected endpoint: {r['ip']}:{r['port']} (NAT: {nat_type})")
+            return r['ip'], r['port'], nat_type
 
-def listen_for_messages(udp_socket):
-    while True:
+class ChatProto(asyncio.DatagramProtocol):
+    """Handle every datagram on the P2P socket and keep the NAT binding alive"""
+    def __init__(self):
+        self.transport = None
+        self.fd = None
+        self.peer_endpoint = None
+        self.received_punch = False
+        self.received_ack = False
+        self.activity = asyncio.Event()
+        self._recv_batch = mmsg.RecvBatch()
+        self._ka_handle = None
+        self._last_send = 0.0
+        self._peer_sock = None
+    
+    def connection_made(self, transport):
+        self.transport = transport
+        self.fd = transport.get_extra_info('socket').fileno()
+    
+    def datagram_received(self, data, addr):
         try:
-            data, addr = udp_socket.recvfrom(1024)
-            message = data.decode()
-            if message == 'KEEPALIVE' or message == 'PUNCH':
-                # Send acknowledgment for connection establishment
-                udp_socket.sendto(b'ACK', addr)
-                continue
-            elif message == 'ACK':
-                continue
-            print(f"\n[Message from {addr}]: {message}")
-            print("> ", end='', flush=True)
+            self.handle_message(data, addr)
+            # Pick up any datagrams that queued behind the first one in a single syscall
+            for data, addr in self._recv_batch.drain(self.fd):
+                self.handle_message(data, addr)
         except Exception as e:
             print("Error receiving message:", e)
-            break
+    
+    def error_received(self, exc):
+        print("Error receiving message:", exc)
+    
+    def handle_message(self, data, addr):
+        # Keep-alives are the bulk of steady-state traffic, so test for them first;
+        # only chat text gets decoded
+        if data == KEEPALIVE:
+            self.send(ACK, addr)
+            return
+        elif data == PUNCH:
+            if not self.received_punch:
+                print(f"Received PUNCH from {addr} - sending ACK")
+                self.received_punch = True
+                self.activity.set()
+            # Send acknowledgment for connection establishment
+            self.send(ACK, addr)
+            return
+        elif data == ACK:
+            if not self.received_ack:
+                print(f"Received ACK from {addr}")
+                self.received_ack = True
+                self.activity.set()
+            return
+        elif len(data) >= 20 and data[4:8] == _STUN_COOKIE_BYTES:
+            # A STUN reply that arrived after get_public_endpoint stopped at quorum
+            return
+        print(f"\n[Message from {addr}]: {data.decode(errors='replace')}")
+        print("> ", end='', flush=True)
+    
+    def connect_peer(self, sock, peer_endpoint):
+        """Connect sock to the peer so sends skip address parsing and the kernel drops other senders"""
+        sock.connect(peer_endpoint)
+        self._peer_sock = sock
+        self.peer_endpoint = peer_endpoint
+    
+    def send(self, data, addr):
+        """Send a datagram, noting the time so keep-alives can be skipped while traffic flows"""
+        if self._peer_sock is not None and addr == self.peer_endpoint:
+            try:
+                self._peer_sock.send(data)
+            except BlockingIOError:
+                pass  # Send buffer full; dropped like any other lost datagram
+            except OSError as exc:
+                # e.g. ECONNREFUSED from an earlier ICMP error; reported the way
+                # transport.sendto would, instead of ending keep-alives or the chat
+                self.error_received(exc)
+        else:
+            self.transport.sendto(data, addr)
+        self._last_send = asyncio.get_running_loop().time()
+    
+    def start_keepalive(self, peer_endpoint):
+        """Keep the NAT binding alive whenever nothing has been sent for keepalive_interval seconds"""
+        self.peer_endpoint = peer_endpoint
+        self._ka()
+    
+    def _ka(self):
+        loop = asyncio.get_running_loop()
+        if loop.time() - self._last_send >= KEEPALIVE_INTERVAL:
+            try:
+                self.send(KEEPALIVE, self.peer_endpoint)
+            except Exception as e:
+                print("Keep-alive error:", e)
+                return
+        # Wake at the absolute monotonic deadline when the binding would next go quiet
+        # for a full interval, so scheduling delays never accumulate
+        self._ka_handle = loop.call_at(self._last_send + KEEPALIVE_INTERVAL, self._ka)
+    
+    def close(self):
+        if self._ka_handle:
+            self._ka_handle.cancel()
+        self.transport.close()
 
-def send_keepalive(udp_socket, peer_endpoint):
-    while True:
-        try:
-            # Send a simple keep-alive packet to maintain NAT binding
-            udp_socket.sendto(b'KEEPALIVE', peer_endpoint)
-            time.sleep(config['client']['keepalive_interval'])
-        except Exception as e:
-            print("Keep-alive error:", e)
-            break
+def backoff_delay(attempt, base=1.0, cap=30):
+    """Truncated exponential backoff with full jitter"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+def is_retryable(error):
+    """Timeouts, connection errors, 429 and 5xx are transient; other HTTP errors are not
+
+    Gateway errors have already been retried by the session's adapter, so they are final here.
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return True
+    if response.status_code in GATEWAY_ERRORS:
+        return False
+    return response.status_code == 429 or response.status_code >= 500
 
 def register_with_server(username, ip, port):
-    """Register with the server and handle retries"""
-    max_retries = 3
-    retry_delay = 2  # seconds
+    """Register with the server and handle retries, returning the advised refresh interval or False"""
+    max_retries = 5
     
     for attempt in range(max_retries):
         try:
@@ -109,41 +345,105 @@ def register_with_server(username, ip, port):
                 'ip': ip,
                 'port': port
             }
-            r = requests.post(f"{SERVER_URL}/register", json=payload)
+            r = _SESSION.post(REGISTER_URL, json=payload)
             r.raise_for_status()
+            body = orjson.loads(r.content)
             print("Successfully registered with rendezvous server.")
-            print(f"Active peers: {r.json().get('active_peers', 0)}")
-            return True
-        except requests.exceptions.RequestException as e:
+            print(f"Active peers: {body.get('active_peers', 0)}")
+            return body.get('refresh_in') or REFRESH_IN
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
             print(f"Registration attempt {attempt + 1} failed: {e}")
+            if not is_retryable(e):
+                print("Registration failed permanently, not retrying.")
+                return False
             if attempt < max_retries - 1:
-                print(f"Retrying in {retry_delay} seconds...")
+                retry_delay = backoff_delay(attempt)
+                print(f"Retrying in {retry_delay:.1f} seconds...")
                 time.sleep(retry_delay)
             else:
                 print("Registration failed after all attempts.")
                 return False
 
-def discover_peer(target_username, max_attempts=30, delay=2):
-    """Discover peer with retry logic"""
+def _valid_cache_entry(entry):
+    """True if entry has the shape save_cached_peer writes"""
+    return (isinstance(entry, dict)
+            and isinstance(entry.get('ip'), str)
+            and isinstance(entry.get('port'), int)
+            and isinstance(entry.get('expires'), (int, float)))
+
+def _read_peer_cache():
+    """Return the unexpired, well-formed entries of the peer cache file"""
+    try:
+        with open(PEER_CACHE_PATH) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}  # Hand-edited or foreign file; start over rather than crash
+    now = time.time()
+    return {name: entry for name, entry in cache.items()
+            if _valid_cache_entry(entry) and entry['expires'] >= now}
+
+def load_cached_peer(username):
+    """Return the cached endpoint for username, or None if missing or expired"""
+    entry = _read_peer_cache().get(username)
+    if not entry:
+        return None
+    return (entry['ip'], entry['port'])
+
+def save_cached_peer(username, endpoint):
+    """Remember a peer endpoint returned by the rendezvous server"""
+    cache = _read_peer_cache()
+    cache[username] = {'ip': endpoint[0], 'port': endpoint[1], 'expires': time.time() + PEER_CACHE_TTL}
+    try:
+        with open(PEER_CACHE_PATH, 'w') as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print(f"Warning: Couldn't save peer cache: {e}")
+
+def probe_endpoint(udp_socket, endpoint, timeout=0.5):
+    """Check whether a peer answers at endpoint with a short PUNCH exchange"""
+    try:
+        udp_socket.sendto(PUNCH, endpoint)
+    except OSError:
+        return False
+    return receive_until(
+        udp_socket, timeout,
+        lambda data, addr: addr == endpoint and data in CONTROL_TOKENS
+    )
+
+def discover_peer(target_username, udp_socket=None, max_attempts=30, delay=2):
+    """Discover peer, trying the local cache first, then the server with jittered exponential backoff"""
+    cached = load_cached_peer(target_username)
+    if cached and udp_socket and probe_endpoint(udp_socket, cached):
+        print(f"Reached cached endpoint for {target_username}: {cached}")
+        return cached
+    
     print(f"Looking for peer {target_username}...")
+    url = f"{SERVER_URL}/get_peer/{quote(target_username, safe='')}"
     
     for attempt in range(max_attempts):
+        wait = backoff_delay(attempt, base=delay)
         try:
-            r = requests.get(f"{SERVER_URL}/get_peer/{target_username}")
+            r = _SESSION.get(url)
             if r.status_code == 200:
-                peer_info = r.json()
-                return (peer_info['ip'], peer_info['port'])
+                peer_info = orjson.loads(r.content)
+                endpoint = (peer_info['ip'], peer_info['port'])
+                save_cached_peer(target_username, endpoint)
+                return endpoint
             elif r.status_code == 404:
                 if attempt < max_attempts - 1:
-                    print(f"Peer not found. Retrying in {delay} seconds... (attempt {attempt + 1}/{max_attempts})")
-                    time.sleep(delay)
+                    print(f"Peer not found. Retrying in {wait:.1f} seconds... (attempt {attempt + 1}/{max_attempts})")
+                    time.sleep(wait)
                 continue
             else:
                 r.raise_for_status()
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
             print(f"Error contacting rendezvous server: {e}")
+            if not is_retryable(e):
+                return None
             if attempt < max_attempts - 1:
-                time.sleep(delay)
+                time.sleep(wait)
             continue
     
     return None
@@ -156,87 +456,80 @@ def create_socket():
     udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
     udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     
-    # Increase socket buffers for better performance
-    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
-    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+    # Large socket buffers absorb PUNCH/ACK bursts (the kernel may clamp to rmem_max/wmem_max)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
     
     # Bind to all interfaces but with a specific port
     udp_socket.bind(('', 0))
     
     return udp_socket
 
-def establish_connection(udp_socket, peer_endpoint):
+async def establish_connection(proto, peer_endpoint):
     """Establish connection with peer using simultaneous UDP hole punching"""
     print("\nInitiating simultaneous UDP hole punching...")
-    print(f"Local endpoint: {udp_socket.getsockname()}")
+    print(f"Local endpoint: {proto.transport.get_extra_info('sockname')}")
     print(f"Peer endpoint: {peer_endpoint}")
     
-    if config['client'].get('cgnat_mode', False):
+    cgnat_mode = CGNAT_MODE
+    if cgnat_mode:
         print("CGNAT mode enabled - using aggressive hole punching")
     
     connection_established = False
-    received_punch = False
     sent_punch = False
     
+    # The NAT opens its pinhole on the first outgoing packet, so a burst needs no spacing
+    burst = [PUNCH] * PUNCH_BURST
+    batch = mmsg.SendBatch(PUNCH_BURST) if mmsg.HAVE_SENDMMSG else None
+    
     def send_punch_packets():
-        """Send burst of punch packets"""
-        for _ in range(5):
-            try:
-                udp_socket.sendto(b'PUNCH', peer_endpoint)
-                time.sleep(0.05)
-            except Exception as e:
-                print(f"Error sending punch packet: {e}")
+        """Send burst of punch packets in a single sendmmsg call where available"""
+        try:
+            sent = batch.send_payloads(proto.fd, burst, peer_endpoint) if batch else 0
+            # Whatever sendmmsg could not place goes through the transport, which
+            # buffers instead of dropping when the socket is momentarily full
+            for packet in burst[sent:]:
+                proto.send(packet, peer_endpoint)
+        except Exception as e:
+            print(f"Error sending punch packet: {e}")
     
     # Start with aggressive burst
     send_punch_packets()
     
-    # Main connection loop
-    start_time = time.time()
-    while time.time() - start_time < config['client']['punch_timeout']:
+    # Main connection loop: wake on incoming PUNCH/ACK or when the next burst is due
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
+    deadline = start_time + PUNCH_TIMEOUT
+    while loop.time() < deadline:
+        # Send additional punch packets after 2 seconds
+        if not sent_punch and loop.time() - start_time > 2:
+            print("Sending additional punch packets...")
+            send_punch_packets()
+            sent_punch = True
+        
+        if proto.received_ack:
+            print("Received ACK - connection established!")
+            connection_established = True
+            break
+        
+        # In CGNAT mode, consider connection established if we've both sent and received packets
+        if cgnat_mode and proto.received_punch and sent_punch:
+            print("CGNAT: Bidirectional communication established!")
+            connection_established = True
+            break
+        
+        wake_at = deadline if sent_punch else min(deadline, start_time + 2)
+        proto.activity.clear()
         try:
-            # Send periodic punch packets
-            if time.time() - start_time > 2 and not sent_punch:  # After 2 seconds
-                print("Sending additional punch packets...")
-                send_punch_packets()
-                sent_punch = True
-            
-            # Try to receive
-            udp_socket.settimeout(1)
-            try:
-                data, addr = udp_socket.recvfrom(4096)
-                message = data.decode()
-                print(f"Received {message} from {addr}")
-                
-                if message == 'PUNCH':
-                    print("Received PUNCH - sending ACK")
-                    udp_socket.sendto(b'ACK', addr)
-                    received_punch = True
-                elif message == 'ACK':
-                    print("Received ACK - connection established!")
-                    connection_established = True
-                    break
-                
-                # In CGNAT mode, consider connection established if we've both sent and received packets
-                if config['client'].get('cgnat_mode', False) and received_punch and sent_punch:
-                    print("CGNAT: Bidirectional communication established!")
-                    connection_established = True
-                    break
-                
-            except socket.timeout:
-                continue
-            
-        except Exception as e:
-            print(f"Error during hole punching: {e}")
-            time.sleep(0.5)
-    
-    # Reset socket timeout
-    udp_socket.settimeout(None)
+            await asyncio.wait_for(proto.activity.wait(), max(0, wake_at - loop.time()))
+        except asyncio.TimeoutError:
+            pass
     
     if connection_established:
         print("\n✓ P2P Connection established successfully!")
     else:
         print("\n✗ Failed to establish P2P connection")
-        if received_punch:
+        if proto.received_punch:
             print("  → Received PUNCH but no ACK")
         elif sent_punch:
             print("  → Sent PUNCH but no response")
@@ -245,13 +538,55 @@ def establish_connection(udp_socket, peer_endpoint):
     
     return connection_established
 
-def main():
+def read_stdin(loop, lines):
+    """Forward stdin lines to the event loop; None marks end of input"""
+    for line in sys.stdin:
+        loop.call_soon_threadsafe(lines.put_nowait, line)
+    loop.call_soon_threadsafe(lines.put_nowait, None)
+
+def watch_stdin(loop, lines):
+    """Feed stdin lines to lines from the event loop itself, or from a thread where it can't be polled"""
+    # A terminal is pollable on POSIX; Windows consoles and redirected input (whose buffered
+    # leftovers a raw read would miss) keep the reader thread
+    if sys.platform == 'win32' or not sys.stdin.isatty():
+        threading.Thread(target=read_stdin, args=(loop, lines), daemon=True).start()
+        return
+    
+    fd = sys.stdin.fileno()
+    pending = bytearray()
+    
+    def on_readable():
+        chunk = os.read(fd, 4096)
+        if not chunk:
+            loop.remove_reader(fd)
+            lines.put_nowait(None)
+            return
+        pending.extend(chunk)
+        while (end := pending.find(b'\n')) >= 0:
+            lines.put_nowait(pending[:end + 1].decode(errors='replace'))
+            del pending[:end + 1]
+    
+    loop.add_reader(fd, on_readable)
+
+async def amain():
+    loop = asyncio.get_running_loop()
     print(f"Connecting to rendezvous server at {SERVER_URL}")
+    status = loop.run_in_executor(None, _SESSION.get, SERVER_URL)
+    
+    # Create and configure UDP socket
+    udp_socket = create_socket()
+    local_port = udp_socket.getsockname()[1]
+    print(f"Local UDP socket bound to: {udp_socket.getsockname()}")
+
+    # STUN needs nothing from the user, so let it run alongside the status check and
+    # prompts; its progress is printed once the prompts are done
+    stun_log = []
+    stun = loop.run_in_executor(None, get_public_endpoint, udp_socket, stun_log.append)
     
     try:
-        r = requests.get(SERVER_URL)
+        r = await status
         r.raise_for_status()
-        print("Server status:", r.json())
+        print("Server status:", orjson.loads(r.content))
     except Exception as e:
         print(f"Error checking server status: {e}")
         return
@@ -260,68 +595,79 @@ def main():
     target_username = input("Enter target username to chat with: ").strip()
 
     # Discover public IP, port, and NAT type using STUN
-    public_ip, public_port, nat_type = get_public_endpoint()
+    public_ip, public_port, nat_type = await stun
+    for line in stun_log:
+        print(line)
     print(f"Public endpoint: {public_ip}:{public_port}")
     print(f"NAT type: {nat_type}")
 
-    # Create and configure UDP socket
-    udp_socket = create_socket()
-    local_port = udp_socket.getsockname()[1]
-    print(f"Local UDP socket bound to: {udp_socket.getsockname()}")
-
     # If STUN failed to get a port, use the local port
     if public_port == 0:
         public_port = local_port
         print("Using local port as public port")
 
     # Register with the server
-    if not register_with_server(username, public_ip, public_port):
+    refresh_in = await loop.run_in_executor(None, register_with_server, username, public_ip, public_port)
+    if not refresh_in:
         return
 
-    # Start registration refresh thread
-    def refresh_registration():
+    # Refresh before the server's advised interval runs out, jittered so clients that
+    # registered together don't all come back at the same moment
+    async def refresh_registration(refresh_in):
         while True:
-            time.sleep(240)  # Refresh every 4 minutes
-            register_with_server(username, public_ip, public_port)
+            await asyncio.sleep(refresh_in * random.uniform(0.8, 1.0))
+            refresh_in = await loop.run_in_executor(
+                None, register_with_server, username, public_ip, public_port
+            ) or REFRESH_IN
     
-    refresh_thread = threading.Thread(target=refresh_registration, daemon=True)
-    refresh_thread.start()
+    refresher = asyncio.create_task(refresh_registration(refresh_in))
 
     # Discover peer with retry
-    peer_endpoint = discover_peer(target_username)
+    peer_endpoint = await loop.run_in_executor(None, discover_peer, target_username, udp_socket)
     if not peer_endpoint:
         print(f"Failed to find peer {target_username} after multiple attempts.")
         return
 
     print(f"Found peer endpoint: {peer_endpoint}")
 
-    # Start a listener thread to receive messages
-    listener_thread = threading.Thread(target=listen_for_messages, args=(udp_socket,), daemon=True)
-    listener_thread.start()
+    # Hand the socket to the event loop; ChatProto receives everything from here on
+    _, proto = await loop.create_datagram_endpoint(ChatProto, sock=udp_socket)
 
-    # Establish connection
-    if not establish_connection(udp_socket, peer_endpoint):
-        print("Failed to establish connection with peer.")
-        return
+    try:
+        # Establish connection
+        if not await establish_connection(proto, peer_endpoint):
+            print("Failed to establish connection with peer.")
+            return
 
-    # Start a keep-alive thread to maintain NAT bindings
-    ka_thread = threading.Thread(target=send_keepalive, args=(udp_socket, peer_endpoint), daemon=True)
-    ka_thread.start()
+        proto.connect_peer(udp_socket, peer_endpoint)
+        # Keep-alives maintain the NAT binding
+        proto.start_keepalive(peer_endpoint)
 
-    print("\nConnection established! You can now start chatting.")
-    print("Press Ctrl+C to exit.")
-    while True:
-        try:
-            message = input("> ")
+        print("\nConnection established! You can now start chatting.")
+        print("Press Ctrl+C to exit.")
+        lines = asyncio.Queue()
+        watch_stdin(loop, lines)
+        while True:
+            print("> ", end='', flush=True)
+            message = await lines.get()
+            if message is None:
+                break
             if message.strip() == "":
                 continue
-            udp_socket.sendto(message.encode(), peer_endpoint)
-        except KeyboardInterrupt:
-            print("\nExiting chat.")
-            break
-        except Exception as e:
-            print("Error sending message:", e)
-            break
+            try:
+                proto.send(message.rstrip('\n').encode(), peer_endpoint)
+            except Exception as e:
+                print("Error sending message:", e)
+                break
+    finally:
+        refresher.cancel()
+        proto.close()
+
+def main():
+    try:
+        asyncio.run(amain())
+    except KeyboardInterrupt:
+        print("\nExiting chat.")
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    main()
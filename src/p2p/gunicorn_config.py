@@ -5,10 +5,14 @@ port = int(os.environ.get("PORT", 10000))
 bind = f"0.0.0.0:{port}"
 
 # Worker configuration
-workers = 2
-threads = 4
-worker_class = "gthread"
+# Requests are tiny in-memory lookups, so one gevent worker multiplexes many
+# connections on greenlets; a single process also keeps one shared registry
+workers = 1
+worker_class = "gevent"
+worker_connections = 1000
 timeout = 120
+# Outlive the proxy's idle timeout so pooled client sessions keep their connection
+keepalive = 75
 
 # Access logging
 accesslog = "-"  # Log to stdout
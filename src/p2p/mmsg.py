@@ -0,0 +1,208 @@
+import ctypes
+import ctypes.util
+import errno
+import socket
+import sys
+
+# Load libc and look up the batched datagram syscalls. The structures below follow the
+# Linux layout; the BSDs export the same calls but lay out sockaddr_in and msghdr
+# differently, so the batches are only enabled on Linux.
+_libc = None
+if sys.platform.startswith('linux'):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        pass
+_sendmmsg = getattr(_libc, 'sendmmsg', None)
+_recvmmsg = getattr(_libc, 'recvmmsg', None)
+
+HAVE_SENDMMSG = _sendmmsg is not None
+HAVE_RECVMMSG = _recvmmsg is not None
+
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)  # Sockets are non-blocking anyway where it is missing
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [
+        ('sin_family', ctypes.c_ushort),
+        ('sin_port', ctypes.c_ushort),  # Network byte order
+        ('sin_addr', ctypes.c_ubyte * 4),
+        ('sin_zero', ctypes.c_ubyte * 8),
+    ]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', msghdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+if HAVE_SENDMMSG:
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+
+if HAVE_RECVMMSG:
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+
+class SendBatch:
+    """Pre-allocated mmsghdr vector for sending many datagrams in one sendmmsg(2) call"""
+    def __init__(self, size):
+        self.size = size
+        self._addrs = (sockaddr_in * size)()
+        self._iovs = (iovec * size)()
+        self._msgs = (mmsghdr * size)()
+        # Keep payloads referenced while the kernel reads from their buffers
+        self._payloads = [None] * size
+        self._ip = None
+
+        for i in range(size):
+            self._addrs[i].sin_family = socket.AF_INET
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._addrs[i])
+            hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+            hdr.msg_iov = ctypes.pointer(self._iovs[i])
+            hdr.msg_iovlen = 1
+
+    def _set_ip(self, ip):
+        if ip == self._ip:
+            return
+        packed = (ctypes.c_ubyte * 4).from_buffer_copy(socket.inet_aton(ip))
+        for addr in self._addrs:
+            addr.sin_addr = packed
+        self._ip = ip
+
+    def _set_payload(self, i, payload):
+        if self._payloads[i] is payload:
+            return
+        self._payloads[i] = payload
+        self._iovs[i].iov_base = ctypes.cast(ctypes.c_char_p(payload), ctypes.c_void_p)
+        self._iovs[i].iov_len = len(payload)
+
+    def _send(self, fd, count):
+        """Submit the first count entries, returning how many were sent"""
+        sent = 0
+        while sent < count:
+            n = _sendmmsg(fd, ctypes.addressof(self._msgs) + sent * ctypes.sizeof(mmsghdr), count - sent, 0)
+            if n < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break  # Socket buffer full; caller decides whether to retry
+                if err == errno.EINTR:
+                    continue
+                raise OSError(err, errno.errorcode.get(err, 'sendmmsg failed'))
+            sent += n
+        return sent
+
+    def send_to_ports(self, fd, payload, ip, ports):
+        """Send the same payload to ip on each of ports"""
+        if len(ports) > self.size:
+            raise ValueError(f"Batch holds at most {self.size} datagrams")
+        self._set_ip(ip)
+        for i, port in enumerate(ports):
+            self._set_payload(i, payload)
+            self._addrs[i].sin_port = socket.htons(port)
+        return self._send(fd, len(ports))
+
+    def send_payloads(self, fd, payloads, endpoint):
+        """Send each payload to the same (ip, port) endpoint"""
+        if len(payloads) > self.size:
+            raise ValueError(f"Batch holds at most {self.size} datagrams")
+        ip, port = endpoint
+        self._set_ip(ip)
+        port = socket.htons(port)
+        for i, payload in enumerate(payloads):
+            self._set_payload(i, payload)
+            self._addrs[i].sin_port = port
+        return self._send(fd, len(payloads))
+
+class RecvBatch:
+    """Pre-allocated buffers for draining queued datagrams with one recvmmsg(2) call"""
+    def __init__(self, size=32, buflen=1500):
+        self.size = size
+        self.buflen = buflen
+        self.supported = HAVE_RECVMMSG
+        self._addrs = (sockaddr_in * size)()
+        self._iovs = (iovec * size)()
+        self._msgs = (mmsghdr * size)()
+        self._bufs = [ctypes.create_string_buffer(buflen) for _ in range(size)]
+
+        for i in range(size):
+            self._iovs[i].iov_base = ctypes.addressof(self._bufs[i])
+            self._iovs[i].iov_len = buflen
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._addrs[i])
+            hdr.msg_iov = ctypes.pointer(self._iovs[i])
+            hdr.msg_iovlen = 1
+
+    def recv(self, fd):
+        """Return up to size (data, addr) pairs already queued on fd, without blocking"""
+        if not self.supported:
+            return []
+
+        # The kernel overwrites the address length, so reset it before every call
+        for msg in self._msgs:
+            msg.msg_hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+
+        n = _recvmmsg(fd, ctypes.addressof(self._msgs), self.size, socket.MSG_DONTWAIT, None)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            if err == errno.ENOSYS:
+                self.supported = False  # Callers keep working with plain recvfrom
+                return []
+            raise OSError(err, errno.errorcode.get(err, 'recvmmsg failed'))
+
+        datagrams = []
+        for i in range(n):
+            addr = self._addrs[i]
+            datagrams.append((
+                ctypes.string_at(self._bufs[i], self._msgs[i].msg_len),
+                (socket.inet_ntoa(bytes(addr.sin_addr)), socket.ntohs(addr.sin_port))
+            ))
+        return datagrams
+
+    def drain(self, fd):
+        """Yield every datagram currently queued on fd"""
+        if not self.supported:
+            yield from self._drain_recvfrom(fd)
+            return
+        while True:
+            datagrams = self.recv(fd)
+            yield from datagrams
+            if len(datagrams) < self.size:
+                return
+
+    def _drain_recvfrom(self, fd):
+        """Fallback drain with one non-blocking recvfrom per datagram"""
+        # Borrow fd without owning it; detach() keeps the wrapper from closing it
+        sock = socket.socket(fileno=fd)
+        buf = bytearray(self.buflen)
+        view = memoryview(buf)
+        try:
+            while True:
+                try:
+                    n, addr = sock.recvfrom_into(buf, self.buflen, _MSG_DONTWAIT)
+                    yield bytes(view[:n]), addr
+                except (BlockingIOError, InterruptedError):
+                    return
+                except ConnectionError:
+                    continue  # Windows reports ICMP port-unreachable as a reset
+        finally:
+            sock.detach()
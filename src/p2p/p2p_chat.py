@@ -1,42 +1,199 @@
 import asyncio
-import json
 import logging
+import random
 import socket
-import time
+import struct
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import orjson
 import requests
 
+import mmsg
+
 logging.basicConfig(level=logging.INFO)
 
 # Port constants
 LOCAL_PORT = 5000  # Fixed internal port for both peers
-MIN_PORT_RANGE = 10000  # Typical lower bound for NAT-assigned ports
+MIN_PORT_RANGE = 1024  # Lowest non-privileged port a NAT may assign
 MAX_PORT_RANGE = 65535  # Maximum port number
 PORT_ATTEMPT_BATCH = 200  # Number of ports to try in each batch
+PORT_HINT_WINDOW = 128  # Ports on either side of a known port to sweep first
+SCAN_RATE = 2000  # Initial heartbeats per second while port scanning
+SCAN_RATE_MIN = 200
+SCAN_RATE_MAX = 20000
+SCAN_MAX_SEND_ERRORS = 5  # Consecutive hard send failures before the scan gives up
+
+# Public IP discovery
+PUBLIC_IP_URLS = [
+    'https://api.ipify.org',
+    'https://ifconfig.me/ip',
+    'https://icanhazip.com',
+]
+PUBLIC_IP_CACHE = Path('~/.p2p_chat/public_ip').expanduser()
+PUBLIC_IP_CACHE_TTL = 24 * 60 * 60  # seconds
+
+# Packet framing: the first byte says what follows
+TAG_HB = 0x48  # b'H' + sender IP
+TAG_ACK = 0x41  # b'A' + sender IP
+TAG_CHAT = 0x43  # b'C' + little-endian uint16 length + UTF-8 message text
+TAG_JSON = 0x7B  # b'{', a JSON-encoded packet in the original format
+
+_CHAT_HEADER = struct.Struct('<BH')
+
+# Socket buffer sizes (the kernel may clamp these to rmem_max/wmem_max)
+RECV_BUFFER_SIZE = 4 * 1024 * 1024
+SEND_BUFFER_SIZE = 2 * 1024 * 1024
+
+def fetch_public_ip(url):
+    """Ask one IP echo service for our address"""
+    response = requests.get(url, timeout=2)
+    response.raise_for_status()
+    ip = response.text.strip()
+    socket.inet_aton(ip)  # Reject anything that isn't an IPv4 address
+    return ip
 
 def get_public_ip():
-    """Get the public IP address of this machine"""
+    """Get the public IP address of this machine, from the local cache or the fastest provider"""
     try:
-        response = requests.get('https://api.ipify.org?format=json')
-        return response.json()['ip']
-    except:
-        return None
+        if time.time() - PUBLIC_IP_CACHE.stat().st_mtime < PUBLIC_IP_CACHE_TTL:
+            return PUBLIC_IP_CACHE.read_text().strip()
+    except OSError:
+        pass
+    
+    executor = ThreadPoolExecutor(max_workers=len(PUBLIC_IP_URLS))
+    try:
+        futures = [executor.submit(fetch_public_ip, url) for url in PUBLIC_IP_URLS]
+        for future in as_completed(futures):
+            try:
+                ip = future.result()
+            except Exception:
+                continue
+            
+            try:
+                PUBLIC_IP_CACHE.parent.mkdir(parents=True, exist_ok=True)
+                PUBLIC_IP_CACHE.write_text(ip)
+            except OSError as e:
+                logging.warning(f"Couldn't cache public IP: {e}")
+            return ip
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return None
+
+class _ChatProto(asyncio.DatagramProtocol):
+    """Dispatch incoming datagrams for a P2PChat session"""
+    def __init__(self, chat):
+        self.chat = chat
+    
+    def datagram_received(self, data, addr):
+        self.handle_datagram(data, addr)
+        
+        # Drain whatever else is already queued with a single recvmmsg call
+        try:
+            for data, addr in self.chat._recv_batch.drain(self.chat.fd):
+                self.handle_datagram(data, addr)
+        except OSError as e:
+            logging.error(f"Error receiving data: {e}")
+    
+    def handle_datagram(self, data, addr):
+        if not data:
+            return
+        chat = self.chat
+        tag = data[0]
+        
+        if tag == TAG_HB:
+            if data[1:] == chat._peer_ip_bytes:
+                self.on_heartbeat(addr)
+        elif tag == TAG_ACK:
+            if data[1:] == chat._peer_ip_bytes:
+                self.on_ack(addr)
+        elif tag == TAG_CHAT:
+            if len(data) < _CHAT_HEADER.size:
+                logging.warning(f"Received truncated chat packet from {addr}")
+                return
+            _, length = _CHAT_HEADER.unpack_from(data)
+            text = data[_CHAT_HEADER.size:_CHAT_HEADER.size + length].decode(errors='replace')
+            print(f"\nReceived: {text}")
+        elif tag == TAG_JSON:
+            self.handle_json(data, addr)
+        else:
+            logging.warning(f"Received unknown packet type {tag:#04x} from {addr}")
+    
+    def on_heartbeat(self, addr):
+        chat = self.chat
+        logging.info(f"Received heartbeat from {addr[0]}:{addr[1]}")
+        
+        # Send acknowledgment
+        chat.transport.sendto(chat._ack_bytes, addr)
+        chat.remote_port = addr[1]
+        chat.connected.set()
+    
+    def on_ack(self, addr):
+        chat = self.chat
+        logging.info(f"Received acknowledgment from {addr[0]}:{addr[1]}")
+        chat.remote_port = addr[1]
+        chat.connected.set()
+    
+    def handle_json(self, data, addr):
+        """Handle packets in the original JSON framing"""
+        chat = self.chat
+        try:
+            message = orjson.loads(data)
+            if message["type"] == "heartbeat" and message["sender_ip"] == chat.peer_public_ip:
+                self.on_heartbeat(addr)
+            elif message["type"] == "ack" and message["sender_ip"] == chat.peer_public_ip:
+                self.on_ack(addr)
+            elif message["type"] == "chat":
+                print(f"\nReceived: {message['content']}")
+                
+        except orjson.JSONDecodeError:
+            logging.warning(f"Received invalid JSON from {addr}")
+        except Exception as e:
+            logging.error(f"Error receiving data: {e}")
+    
+    def error_received(self, exc):
+        logging.error(f"Error receiving data: {exc}")
 
 class P2PChat:
-    def __init__(self, my_public_ip, peer_public_ip, is_peer_a):
+    def __init__(self, my_public_ip, peer_public_ip, is_peer_a, peer_port_hint=None):
         self.sock = None
+        self.fd = None
+        self.transport = None
+        self._batch = None
         self.my_public_ip = my_public_ip
         self.peer_public_ip = peer_public_ip
         self.is_peer_a = is_peer_a
+        self.peer_port_hint = peer_port_hint
         self.remote_port = None
         self.stop_punching = False
         self.connected = asyncio.Event()
         
     async def setup(self):
-        """Setup UDP socket"""
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.bind(('0.0.0.0', LOCAL_PORT))
-        self.sock.setblocking(False)
+        """Setup UDP endpoint"""
+        loop = asyncio.get_running_loop()
+        
+        # Resolve the peer address once; sendto() on a hostname would hit getaddrinfo for every packet
+        infos = await loop.getaddrinfo(self.peer_public_ip, None, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self.peer_public_ip = infos[0][4][0]
+        
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: _ChatProto(self),
+            local_addr=('0.0.0.0', LOCAL_PORT)
+        )
+        self.sock = self.transport.get_extra_info('socket')
+        self.fd = self.sock.fileno()
+        # Room for a whole port-scan batch and the acks it may provoke
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+        self._batch = mmsg.SendBatch(PORT_ATTEMPT_BATCH) if mmsg.HAVE_SENDMMSG else None
+        self._recv_batch = mmsg.RecvBatch()
+        
+        # Control packets never change during a session, so encode them once
+        self._peer_ip_bytes = self.peer_public_ip.encode()
+        self._hb_bytes = bytes([TAG_HB]) + self.my_public_ip.encode()
+        self._ack_bytes = bytes([TAG_ACK]) + self.my_public_ip.encode()
         logging.info(f"Bound to local port {LOCAL_PORT}")
         logging.info(f"My Public IP: {self.my_public_ip}")
         logging.info(f"Peer Public IP: {self.peer_public_ip}")
@@ -45,60 +202,25 @@ class P2PChat:
     async def send_heartbeat(self, port):
         """Send a heartbeat packet to the peer's IP and specified port"""
         try:
-            message = json.dumps({
-                "type": "heartbeat",
-                "sender_ip": self.my_public_ip,
-                "timestamp": time.time()
-            }).encode()
-            self.sock.sendto(message, (self.peer_public_ip, port))
+            self.transport.sendto(self._hb_bytes, (self.peer_public_ip, port))
             return True
         except Exception as e:
             logging.error(f"Error sending heartbeat: {e}")
             return False
     
-    async def listen_for_messages(self):
-        """Listen for incoming messages"""
+    async def wait_connected(self, timeout):
+        """Wait up to timeout seconds for the handshake, returning as soon as it completes"""
         try:
-            while not self.stop_punching:
-                try:
-                    data, addr = self.sock.recvfrom(1024)
-                    remote_ip, remote_port = addr
-                    
-                    try:
-                        message = json.loads(data.decode())
-                        if message["type"] == "heartbeat" and message["sender_ip"] == self.peer_public_ip:
-                            logging.info(f"Received heartbeat from {remote_ip}:{remote_port}")
-                            
-                            # Send acknowledgment
-                            ack = json.dumps({
-                                "type": "ack",
-                                "sender_ip": self.my_public_ip,
-                                "timestamp": time.time()
-                            }).encode()
-                            self.sock.sendto(ack, addr)
-                            self.remote_port = remote_port
-                            self.connected.set()
-                            
-                        elif message["type"] == "ack" and message["sender_ip"] == self.peer_public_ip:
-                            logging.info(f"Received acknowledgment from {remote_ip}:{remote_port}")
-                            self.remote_port = remote_port
-                            self.connected.set()
-                            
-                        elif message["type"] == "chat":
-                            print(f"\nReceived: {message['content']}")
-                            
-                    except json.JSONDecodeError:
-                        logging.warning(f"Received invalid JSON from {addr}")
-                        
-                except BlockingIOError:
-                    await asyncio.sleep(0.1)
-                    
-                except Exception as e:
-                    logging.error(f"Error receiving data: {e}")
-                    await asyncio.sleep(0.1)
-                    
-        except Exception as e:
-            logging.error(f"Error in listen_for_messages: {e}")
+            await asyncio.wait_for(self.connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.connected.is_set()
+    
+    def close(self):
+        """Stop punching and release the UDP endpoint"""
+        self.stop_punching = True
+        if self.transport:
+            self.transport.close()
     
     async def initiate_connection(self):
         """Peer A: Send heartbeats on a fixed port and wait for response"""
@@ -106,37 +228,104 @@ class P2PChat:
             return False
             
         logging.info("Starting connection as Peer A (Initiator)")
-        listen_task = asyncio.create_task(self.listen_for_messages())
         
         # As Peer A, we'll send heartbeats on port 5000 (the known listening port)
         while not self.stop_punching and not self.connected.is_set():
             await self.send_heartbeat(LOCAL_PORT)
-            await asyncio.sleep(1)
+            await self.wait_connected(1)
             
         return self.connected.is_set()
     
+    def _sendmmsg_batch(self, payload, ports):
+        """Send payload to every port of the peer, in one sendmmsg call where available
+
+        Returns how many were sent, fewer when the socket buffer fills up; hard errors raise OSError.
+        """
+        if self._batch is None:
+            for i, port in enumerate(ports):
+                # The transport only buffers once the kernel pushes back
+                if self.transport.get_write_buffer_size():
+                    return i
+                self.transport.sendto(payload, (self.peer_public_ip, port))
+            return len(ports)
+        
+        sent = self._batch.send_to_ports(self.fd, payload, self.peer_public_ip, ports)
+        if sent < len(ports):
+            logging.debug(f"Socket buffer full, sent {sent}/{len(ports)} heartbeats")
+        return sent
+    
+    def _scan_order(self):
+        """Ports to probe: the neighborhood of a known peer port first, then the rest at random"""
+        ports = list(range(MIN_PORT_RANGE, MAX_PORT_RANGE + 1))
+        random.shuffle(ports)
+        
+        if not self.peer_port_hint:
+            return ports
+        
+        # NATs tend to allocate near previous mappings, so sweep outward from the hint
+        hint = self.peer_port_hint
+        low = max(MIN_PORT_RANGE, hint - PORT_HINT_WINDOW)
+        high = min(MAX_PORT_RANGE, hint + PORT_HINT_WINDOW)
+        nearby = sorted(range(low, high + 1), key=lambda port: abs(port - hint))
+        return nearby + [port for port in ports if not low <= port <= high]
+    
     async def brute_force_connect(self):
         """Peer B: Try to find the port Peer A is listening on"""
         if self.is_peer_a:
             return False
             
         logging.info("Starting connection as Peer B (Port Scanner)")
-        listen_task = asyncio.create_task(self.listen_for_messages())
         
-        current_port = MIN_PORT_RANGE
-        while current_port <= MAX_PORT_RANGE and not self.stop_punching:
-            batch_end = min(current_port + PORT_ATTEMPT_BATCH, MAX_PORT_RANGE + 1)
-            logging.info(f"Trying ports {current_port}-{batch_end-1}")
+        # Token bucket: spend one token per heartbeat, refilled at `rate` per second.
+        # The rate backs off when the kernel refuses datagrams and creeps up while it accepts them.
+        loop = asyncio.get_running_loop()
+        rate = SCAN_RATE
+        tokens = float(PORT_ATTEMPT_BATCH)
+        last = loop.time()
+        
+        ports = self._scan_order()
+        pos = 0
+        errors = 0
+        while pos < len(ports) and not self.stop_punching:
+            batch = ports[pos:pos + PORT_ATTEMPT_BATCH]
             
-            for port in range(current_port, batch_end):
-                await self.send_heartbeat(port)
-                
-                if self.connected.is_set():
-                    logging.info(f"Successfully connected to port {self.remote_port}")
-                    return True
+            now = loop.time()
+            tokens = min(PORT_ATTEMPT_BATCH, tokens + rate * (now - last))
+            last = now
+            if tokens < len(batch):
+                if await self.wait_connected((len(batch) - tokens) / rate):
+                    break
+                continue
+            
+            logging.info(f"Trying ports {pos + 1}-{pos + len(batch)} of {len(ports)} at {rate:.0f} pps")
+            # Every attempt is charged in full, so a full or failing socket is retried at
+            # the bucket's pace rather than in a tight loop
+            tokens -= len(batch)
+            try:
+                sent = self._sendmmsg_batch(self._hb_bytes, batch)
+            except OSError as e:
+                errors += 1
+                logging.error(f"Error sending heartbeat batch: {e}")
+                if errors >= SCAN_MAX_SEND_ERRORS:
+                    logging.error("Giving up the port scan after repeated send errors")
+                    break
+                continue
+            errors = 0
+            pos += sent
+            if sent < len(batch):
+                rate = max(SCAN_RATE_MIN, rate * 0.8)
+            else:
+                rate = min(SCAN_RATE_MAX, rate * 1.05)
             
-            await asyncio.sleep(0.5)
-            current_port = batch_end
+            # Yield so queued acks get dispatched before the next batch
+            await asyncio.sleep(0)
+            if self.connected.is_set():
+                break
+        
+        # Give replies to the last batch a moment to arrive
+        if await self.wait_connected(1):
+            logging.info(f"Successfully connected to port {self.remote_port}")
+            return True
         
         self.stop_punching = True
         return False
@@ -148,12 +337,9 @@ class P2PChat:
             return False
             
         try:
-            encoded_message = json.dumps({
-                "type": "chat",
-                "content": message,
-                "sender_ip": self.my_public_ip
-            }).encode()
-            self.sock.sendto(encoded_message, (self.peer_public_ip, self.remote_port))
+            body = message.encode()
+            encoded_message = _CHAT_HEADER.pack(TAG_CHAT, len(body)) + body
+            self.transport.sendto(encoded_message, (self.peer_public_ip, self.remote_port))
             logging.info(f"Sent message: {message}")
             return True
         except Exception as e:
@@ -178,7 +364,13 @@ async def main():
     
     is_peer_a = choice == "1"
     
-    chat = P2PChat(my_public_ip, peer_public_ip, is_peer_a)
+    peer_port_hint = None
+    if not is_peer_a:
+        hint = input("Enter the peer's last known public port (leave blank if unknown): ").strip()
+        if hint.isdigit():
+            peer_port_hint = int(hint)
+    
+    chat = P2PChat(my_public_ip, peer_public_ip, is_peer_a, peer_port_hint)
     await chat.setup()
     
     try:
@@ -203,9 +395,7 @@ async def main():
     except KeyboardInterrupt:
         print("\nClosing connection...")
     finally:
-        chat.stop_punching = True
-        if chat.sock:
-            chat.sock.close()
+        chat.close()
 
 if __name__ == "__main__":
     asyncio.run(main()) 
\ No newline at end of file
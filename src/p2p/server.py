@@ -1,7 +1,12 @@
-from flask import Flask, request, jsonify
-import json
+from flask import Flask, request
+from flask.json.provider import JSONProvider
+import orjson
 import os
 import logging
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
 from datetime import datetime
 
 # Set up logging
@@ -11,103 +16,146 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+class ORJSONProvider(JSONProvider):
+    """Route Flask's own JSON handling (request.get_json, jsonify) through orjson"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
-# In-memory registry mapping usernames to their public endpoint
-# Add timestamp to handle stale entries
-registry = {}
+app = Flask(__name__)
+app.json = ORJSONProvider(app)
+
+def J(obj, status=200):
+    """Serialize obj with orjson into a JSON response"""
+    return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
+
+# In-memory registry mapping usernames to their public endpoint, ordered from
+# least to most recently refreshed so stale entries can be swept from the front
+registry = OrderedDict()
+registry_lock = threading.RLock()
+STALE_AFTER = 300  # seconds
+# Advised re-registration interval, clamped well inside STALE_AFTER so clients
+# always refresh before they would be swept
+REFRESH_IN = min(int(os.environ.get('REFRESH_IN', 240)), STALE_AFTER - 60)
+MAX_LISTED_PEERS = 1000
+
+# Bumped whenever a username joins or leaves the registry, so /list_peers can
+# reuse its serialized body until membership actually changes
+registry_version = 0
+_peers_cache = (None, None)  # (registry_version, response body)
 
 def cleanup_stale_entries():
     """Remove entries older than 5 minutes"""
-    now = datetime.now()
-    stale_users = [
-        username for username, data in registry.items()
-        if (now - data['timestamp']).total_seconds() > 300
-    ]
-    for username in stale_users:
-        del registry[username]
-        logger.info(f"Removed stale entry for user: {username}")
+    global registry_version
+    now = time.monotonic()
+    with registry_lock:
+        while registry:
+            username, data = next(iter(registry.items()))
+            if now - data['timestamp'] <= STALE_AFTER:
+                break
+            registry.popitem(last=False)
+            registry_version += 1
+            logger.info(f"Removed stale entry for user: {username}")
 
 @app.route('/')
 def home():
     cleanup_stale_entries()
-    return jsonify({
+    with registry_lock:
+        active_peers = len(registry)
+    body = {
         'status': 'running',
-        'active_peers': len(registry),
-        'server_time': datetime.now().isoformat()
-    })
+        'active_peers': active_peers
+    }
+    if request.args.get('verbose') == '1':
+        body['server_time'] = datetime.now().isoformat()
+    return J(body)
 
 @app.route('/register', methods=['POST'])
 def register():
+    global registry_version
     try:
-        data = request.json
+        data = request.get_json(silent=True, cache=False)
         if not data:
-            return jsonify({'status': 'error', 'message': 'No JSON data received'}), 400
+            return J({'status': 'error', 'message': 'No JSON data received'}, 400)
 
         username = data.get('username')
         ip = data.get('ip')
         port = data.get('port')
 
         if not all([username, ip, port]):
-            return jsonify({'status': 'error', 'message': 'Missing required parameters'}), 400
+            return J({'status': 'error', 'message': 'Missing required parameters'}, 400)
 
         try:
             port = int(port)
         except (TypeError, ValueError):
-            return jsonify({'status': 'error', 'message': 'Port must be a number'}), 400
-
-        # Store endpoint with timestamp
-        registry[username] = {
-            'endpoint': (ip, port),
-            'timestamp': datetime.now()
-        }
+            return J({'status': 'error', 'message': 'Port must be a number'}, 400)
+
+        # Store endpoint with timestamp, moving the user to the fresh end
+        with registry_lock:
+            if registry.pop(username, None) is None:
+                registry_version += 1
+            registry[username] = {
+                'endpoint': (ip, port),
+                'timestamp': time.monotonic()
+            }
         logger.info(f"Registered user {username} at {ip}:{port}")
         
         # Cleanup old entries
         cleanup_stale_entries()
         
-        return jsonify({
+        with registry_lock:
+            active_peers = len(registry)
+        return J({
             'status': 'success',
             'message': 'Successfully registered',
-            'active_peers': len(registry)
+            'active_peers': active_peers,
+            'refresh_in': REFRESH_IN
         })
 
     except Exception as e:
         logger.error(f"Error in register endpoint: {str(e)}")
-        return jsonify({'status': 'error', 'message': 'Internal server error'}), 500
+        return J({'status': 'error', 'message': 'Internal server error'}, 500)
 
 @app.route('/get_peer/<username>', methods=['GET'])
 def get_peer(username):
     try:
         cleanup_stale_entries()
         
-        if username not in registry:
-            return jsonify({'status': 'error', 'message': 'Peer not found'}), 404
-
-        ip, port = registry[username]['endpoint']
-        # Update timestamp
-        registry[username]['timestamp'] = datetime.now()
+        with registry_lock:
+            if username not in registry:
+                return J({'status': 'error', 'message': 'Peer not found'}, 404)
+
+            ip, port = registry[username]['endpoint']
+            # Update timestamp
+            registry[username]['timestamp'] = time.monotonic()
+            registry.move_to_end(username)
         
         logger.info(f"Retrieved peer info for {username}: {ip}:{port}")
-        return jsonify({'ip': ip, 'port': port})
+        return J({'ip': ip, 'port': port})
 
     except Exception as e:
         logger.error(f"Error in get_peer endpoint: {str(e)}")
-        return jsonify({'status': 'error', 'message': 'Internal server error'}), 500
+        return J({'status': 'error', 'message': 'Internal server error'}, 500)
 
 @app.route('/list_peers', methods=['GET'])
 def list_peers():
+    global _peers_cache
     try:
         cleanup_stale_entries()
-        peers = list(registry.keys())
-        return jsonify({
-            'peers': peers,
-            'count': len(peers),
-            'server_time': datetime.now().isoformat()
-        })
+        with registry_lock:
+            version, body = _peers_cache
+            if version != registry_version:
+                body = orjson.dumps({
+                    'peers': list(islice(registry, MAX_LISTED_PEERS)),
+                    'count': len(registry)
+                })
+                _peers_cache = (registry_version, body)
+        return app.response_class(body, mimetype='application/json')
     except Exception as e:
         logger.error(f"Error in list_peers endpoint: {str(e)}")
-        return jsonify({'status': 'error', 'message': 'Internal server error'}), 500
+        return J({'status': 'error', 'message': 'Internal server error'}, 500)
 
 if __name__ == '__main__':
     # Get port from environment variable (for cloud deployment) or use default
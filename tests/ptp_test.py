@@ -1,10 +1,19 @@
+import collections
+import itertools
 import socket
+import struct
+import sys
 import threading
 import time
 import os
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import queue
+import selectors
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
 import genarate_shared_key as key
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'p2p'))
+import mmsg
+
 # Manually define public IPs and ports of both peers
 PEER_A_PUBLIC_IP = "100.110.0.2"  # For local testing
 PEER_B_PUBLIC_IP = "5.29.22.99"  # For local testing
@@ -12,10 +21,59 @@ PORT = 5000
 
 # Packet spam rate (packets per second)
 PACKET_SPAM_RATE = 5
+SPAM_BATCH = PACKET_SPAM_RATE  # One second's worth of packets per sendmmsg call
+RECV_BATCH = 16  # Datagrams collected per recvmmsg call
+RECV_BUFFER = 1500  # Bytes per receive buffer; a full Ethernet MTU, above MAX_DATAGRAM
+DECRYPT_WORKERS = 2
+CHAT_BATCH = 16  # Chat datagrams sent per sendmmsg call when a paste spans several
+
+RECV_BUFFER_SIZE = 4 * 1024 * 1024
+SEND_BUFFER_SIZE = 4 * 1024 * 1024
+# Linux <linux/in.h> values; the socket module does not export them
+IP_MTU_DISCOVER = 10
+IP_PMTUDISC_DONT = 0
+UDP_SEGMENT = 103  # <linux/udp.h>, kernel 4.18+
+
+# Datagram plaintext: one or more records of big-endian uint16 length + UTF-8 text
+_RECORD_HEADER = struct.Struct(">H")
+MAX_DATAGRAM = 1400  # Lines batched into one datagram stay under common path MTUs
+MAX_PLAINTEXT = MAX_DATAGRAM - 12 - 16  # Less the nonce and the AEAD tag
+MAX_RECORD_BODY = MAX_PLAINTEXT - _RECORD_HEADER.size  # Longer lines are split
+
+# Hole-punching payload, framed once
+SPAM_TEXT = "HOLE PUNCHING ATTEMPT"
+SPAM_PLAINTEXT = _RECORD_HEADER.pack(len(SPAM_TEXT)) + SPAM_TEXT.encode()
+
+OUTPUT_FLUSH_INTERVAL = 0.1  # Seconds between writes of received messages to stdout
 
 # Generate a shared AES key (must be the same on both peers)
 SHARED_KEY = key.SHARED_KEY
 
+# ChaCha20-Poly1305 is much faster than software AES on CPUs without AES instructions.
+# Both peers must pick the same one: P2P_AEAD=chacha20, default AES-GCM.
+AEAD_CIPHERS = {"aesgcm": AESGCM, "chacha20": ChaCha20Poly1305}
+AEAD_NAME = os.environ.get("P2P_AEAD", "aesgcm").strip().lower()
+if AEAD_NAME not in AEAD_CIPHERS:
+    sys.exit(f"Unknown P2P_AEAD {AEAD_NAME!r}; use one of {', '.join(AEAD_CIPHERS)}")
+
+# Expand the key once; the instance is safe to share across threads as long as nonces are unique
+_AEAD = AEAD_CIPHERS[AEAD_NAME](SHARED_KEY)
+
+# Nonce = random 32-bit prefix chosen per run + 64-bit counter, so packets need no
+# getrandom() call each; a fresh prefix on every start keeps restarts from reusing nonces
+_NONCE_PREFIX = os.urandom(4)
+_NONCE_COUNTER = itertools.count()
+_NONCE_LOCK = threading.Lock()
+_NONCE = struct.Struct(">4sQ")  # Packed in one call, so each nonce is a single bytes object
+
+
+def next_nonce():
+    """Returns a 96-bit nonce never used before by this process."""
+    with _NONCE_LOCK:
+        count = next(_NONCE_COUNTER)
+    return _NONCE.pack(_NONCE_PREFIX, count)
+
+
 def detect_nat_type():
     """Simple function to return local IP for testing."""
     try:    
@@ -30,62 +88,331 @@ def detect_nat_type():
         return "Unknown"
 
 
+def cpu_has_aes():
+    """Returns False when /proc/cpuinfo shows no AES instructions, True otherwise."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                # "flags" on x86, "Features" on ARM
+                if line.startswith(("flags", "Features")):
+                    return "aes" in line.split(":", 1)[1].split()
+    except OSError:
+        pass
+    return True  # Unknown platform; assume hardware AES
+
+
+def split_body(body):
+    """Cuts an encoded line into pieces that each fit one record in one datagram."""
+    while len(body) > MAX_RECORD_BODY:
+        cut = MAX_RECORD_BODY
+        while body[cut] & 0xC0 == 0x80:  # Never cut inside a UTF-8 character
+            cut -= 1
+        yield body[:cut]
+        body = body[cut:]
+    yield body
+
+
+def frame_messages(messages):
+    """Packs messages into as few plaintexts as fit one datagram each."""
+    plaintexts = []
+    current = bytearray()
+    for message in messages:
+        for body in split_body(message.encode()):
+            if current and len(current) + _RECORD_HEADER.size + len(body) > MAX_PLAINTEXT:
+                plaintexts.append(bytes(current))
+                current = bytearray()
+            current += _RECORD_HEADER.pack(len(body))
+            current += body
+    if current:
+        plaintexts.append(bytes(current))
+    return plaintexts
+
+
+def unframe_messages(plaintext):
+    """Splits a decrypted plaintext back into its messages."""
+    messages = []
+    offset = 0
+    while offset + _RECORD_HEADER.size <= len(plaintext):
+        (length,) = _RECORD_HEADER.unpack_from(plaintext, offset)
+        offset += _RECORD_HEADER.size
+        messages.append(plaintext[offset:offset + length].decode(errors="replace"))
+        offset += length
+    return messages
+
+
+def encrypt_bytes(plaintext):
+    """Encrypts already-encoded bytes with the configured AEAD."""
+    nonce = next_nonce()
+    encrypted_data = _AEAD.encrypt(nonce, plaintext, None)
+    return nonce + encrypted_data  # Send nonce with encrypted data; one copy into a new bytes
+
+
 def encrypt_message(message):
-    """Encrypts a message using AES-GCM."""
-    aesgcm = AESGCM(SHARED_KEY)
-    nonce = os.urandom(12)  # 96-bit nonce
-    encrypted_data = aesgcm.encrypt(nonce, message.encode(), None)
-    return nonce + encrypted_data  # Send nonce with encrypted data
+    """Encrypts a single message with the configured AEAD."""
+    return encrypt_bytes(frame_messages([message])[0])
 
 
 def decrypt_message(encrypted_message):
-    """Decrypts a message using AES-GCM."""
-    aesgcm = AESGCM(SHARED_KEY)
-    nonce = encrypted_message[:12]  # Extract nonce
-    ciphertext = encrypted_message[12:]
+    """Decrypts a datagram with the configured AEAD and returns the messages it carries."""
+    # Both AEADs take any bytes-like, so slice a view instead of copying into two new bytes
+    view = memoryview(encrypted_message)
+    nonce = view[:12]  # Extract nonce
+    ciphertext = view[12:]
     try:
-        return aesgcm.decrypt(nonce, ciphertext, None).decode()
+        return unframe_messages(_AEAD.decrypt(nonce, ciphertext, None))
     except Exception as e:
         print(f"[ERROR] Decryption failed: {e}")
-        return "[Decryption Error]"
+        return ["[Decryption Error]"]
+
+
+# Received messages wait here for flush_output(); deque appends need no lock
+_OUTPUT = collections.deque()
+
+
+def flush_output():
+    """ Writes queued peer messages to stdout in one write per interval."""
+    while True:
+        time.sleep(OUTPUT_FLUSH_INTERVAL)
+        if _OUTPUT:
+            lines = []
+            while _OUTPUT:
+                lines.append(_OUTPUT.popleft())
+            sys.stdout.write("".join(lines))
+            sys.stdout.flush()
+
+
+def decrypt_worker(inbox):
+    """ Decrypts datagrams handed over by the listener and queues them for output."""
+    # Peers replay one encrypted hole-punching packet verbatim, so a byte-identical copy of
+    # one that already authenticated is skipped without running the cipher again
+    punch_packets = {}
+    while True:
+        data, addr = inbox.get()
+        if punch_packets.get(addr) == data:
+            continue
+        messages = decrypt_message(data)
+        if messages == [SPAM_TEXT]:
+            # Hole-punching packets arrive several times a second; report only the first
+            if addr not in punch_packets:
+                _OUTPUT.append(f"\n[PUNCHED] Receiving from {addr[0]}:{addr[1]}\n")
+            punch_packets[addr] = data
+            continue
+        for message in messages:
+            _OUTPUT.append(f"\n[PEER]: {message}\n")
+
+
+def start_decrypt_workers():
+    """ Starts the decrypt threads and returns one inbox queue per worker."""
+    # Decryption runs off the receive path so the socket keeps draining meanwhile
+    # (the AEAD releases the GIL)
+    inboxes = [queue.SimpleQueue() for _ in range(DECRYPT_WORKERS)]
+    for inbox in inboxes:
+        threading.Thread(target=decrypt_worker, args=(inbox,), daemon=True).start()
+    threading.Thread(target=flush_output, daemon=True).start()
+    return inboxes
+
+
+def dispatch(datagrams, inboxes):
+    """ Hands received datagrams to the decrypt workers."""
+    # Hashing the sender keeps each peer's messages in order
+    workers = len(inboxes)
+    for item in datagrams:
+        inboxes[hash(item[1]) % workers].put(item)
 
 
 def udp_listener(sock):
     """ Listens for incoming UDP messages using the shared socket."""
     print(f"[LISTENING] on port {PORT}...")
+    inboxes = start_decrypt_workers()
+    buf = bytearray(RECV_BUFFER)
+    view = memoryview(buf)
     while True:
         try:
-            data, addr = sock.recvfrom(1024)
-            message = decrypt_message(data)
-            print(f"\n[PEER]: {message}")
+            # Receive into the one reused buffer; the exact-size copy is what the
+            # decrypt worker keeps, since buf is overwritten by the next datagram
+            n, addr = sock.recvfrom_into(buf)
+            dispatch([(bytes(view[:n]), addr)], inboxes)
+        except ConnectionError:
+            pass  # ICMP port-unreachable on the connected socket: the peer is not up yet
         except Exception as e:
             print(f"[ERROR] Receiving message: {e}")
 
 
+def make_spam_burst(sock, target_ip):
+    """ Returns a function that sends one burst of SPAM_BATCH hole-punching packets."""
+    # Encrypted once and replayed verbatim: resending an identical nonce+ciphertext
+    # reveals nothing new, and keeps cipher work out of the send loop entirely
+    message = encrypt_bytes(SPAM_PLAINTEXT)
+    burst = [message] * SPAM_BATCH
+    batch = mmsg.SendBatch(SPAM_BATCH) if mmsg.HAVE_SENDMMSG else None
+    # With UDP GSO the whole burst is one buffer that the kernel cuts into
+    # len(message)-sized datagrams. The segment size goes in a per-call cmsg so chat
+    # messages on the same socket are never split.
+    gso_buffer = message * SPAM_BATCH
+    gso_cmsg = [(socket.IPPROTO_UDP, UDP_SEGMENT, struct.pack("=H", len(message)))]
+    use_gso = sys.platform.startswith("linux")
+    fd = sock.fileno()
+    endpoint = (target_ip, PORT)
+
+    def send_burst():
+        nonlocal use_gso
+        if use_gso:
+            try:
+                sock.sendmsg([gso_buffer], gso_cmsg)
+                return
+            except (BlockingIOError, ConnectionError):
+                raise  # Send buffer full or peer unreachable, not a missing feature
+            except OSError:
+                use_gso = False  # Older kernel or no GSO on this route; use the paths below
+        if batch:
+            batch.send_payloads(fd, burst, endpoint)
+        else:
+            for packet in burst:
+                sock.send(packet)
+
+    return send_burst
+
+
+def next_spam_deadline(deadline, interval, now):
+    """ Returns the burst deadline after deadline, counted from the schedule rather than now."""
+    # Adding to the previous deadline keeps sleep overshoot from accumulating into drift;
+    # after a stall (suspend, long GC) restart from now instead of bursting to catch up
+    deadline += interval
+    return deadline if deadline > now else now
+
+
 def udp_spammer(sock, target_ip):
     """ Continuously sends UDP packets (hole punching) using the shared socket."""
-    message = encrypt_message("HOLE PUNCHING ATTEMPT")
+    send_burst = make_spam_burst(sock, target_ip)
+    spam_interval = SPAM_BATCH / PACKET_SPAM_RATE
+    next_burst = time.monotonic()
     while True:
         try:
-            sock.sendto(message, (target_ip, PORT))
-            time.sleep(1 / PACKET_SPAM_RATE)
+            send_burst()
+        except ConnectionError:
+            pass  # An earlier packet hit a closed port; expected until the peer is up
         except Exception as e:
             print(f"[ERROR] Sending UDP packet: {e}")
             break
+        next_burst = next_spam_deadline(next_burst, spam_interval, time.monotonic())
+        time.sleep(max(0.0, next_burst - time.monotonic()))
+
+
+def send_chats(sock, messages, target_ip, batch=None):
+    """ Encrypts and sends chat lines together; returns False once the user asks to exit."""
+    lines = []
+    keep_going = True
+    for message in messages:
+        if message.lower() == "exit":
+            keep_going = False
+            break
+        lines.append(message)
+    # Lines share datagrams, so one AEAD call and one nonce+tag cover several of them
+    payloads = [encrypt_bytes(plaintext) for plaintext in frame_messages(lines)]
+    try:
+        sent = 0
+        if batch:
+            # A long paste goes out in one sendmmsg call per batch.size datagrams
+            while sent < len(payloads):
+                chunk = payloads[sent:sent + batch.size]
+                n = batch.send_payloads(sock.fileno(), chunk, (target_ip, PORT))
+                sent += n
+                if n < len(chunk):
+                    break  # Send buffer full; the rest go one by one below
+        for payload in payloads[sent:]:
+            sock.send(payload)
+    except Exception as e:
+        print(f"[ERROR] Sending chat message: {e}")
+    if not keep_going:
+        print("Exiting chat...")
+    return keep_going
+
+
+def read_lines(lines):
+    """ Feeds stdin lines to the chat sender, ending with None at EOF."""
+    for line in sys.stdin:
+        lines.put(line.rstrip("\r\n"))
+    lines.put(None)
 
 
 def chat_sender(sock, target_ip):
     """ Sends chat messages to the peer using the shared socket."""
+    # stdin is read on its own thread so lines that arrive together are sent together
+    lines = queue.SimpleQueue()
+    threading.Thread(target=read_lines, args=(lines,), daemon=True).start()
     while True:
-        message = input("You: ")
-        if message.lower() == "exit":
-            print("Exiting chat...")
+        print("You: ", end="", flush=True)
+        messages = [lines.get()]
+        while True:
+            try:
+                messages.append(lines.get_nowait())
+            except queue.Empty:
+                break
+        if None in messages:
+            send_chats(sock, messages[:messages.index(None)], target_ip)
             break
-        try:
-            encrypted_message = encrypt_message(message)
-            sock.sendto(encrypted_message, (target_ip, PORT))
-        except Exception as e:
-            print(f"[ERROR] Sending chat message: {e}")
+        if not send_chats(sock, messages, target_ip):
+            break
+
+
+def event_loop(sock, target_ip):
+    """ Serves receiving, hole punching and chat input from one selectors loop."""
+    print(f"[LISTENING] on port {PORT}...")
+    inboxes = start_decrypt_workers()
+    batch = mmsg.RecvBatch(size=RECV_BATCH, buflen=RECV_BUFFER)
+    send_burst = make_spam_burst(sock, target_ip)
+    chat_batch = mmsg.SendBatch(CHAT_BATCH) if mmsg.HAVE_SENDMMSG else None
+    spam_interval = SPAM_BATCH / PACKET_SPAM_RATE
+    # Per-iteration lookups bound once; the loop runs for every datagram batch and timer tick
+    monotonic = time.monotonic
+    fd = sock.fileno()
+    drain = batch.drain
+    next_burst = monotonic()
+
+    sock.setblocking(False)  # Already so on Linux; other platforms lack SOCK_NONBLOCK
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    stdin_fd = sys.stdin.fileno()
+    selector.register(stdin_fd, selectors.EVENT_READ)
+    pending = b""
+    print("You: ", end="", flush=True)
+    while True:
+        now = monotonic()
+        if now >= next_burst:
+            next_burst = next_spam_deadline(next_burst, spam_interval, now)
+            try:
+                send_burst()
+            except (BlockingIOError, ConnectionRefusedError):
+                # Send buffer full, or an earlier packet hit a closed port because the peer
+                # is not up yet; either way the next burst goes out on schedule
+                pass
+            except OSError as e:
+                print(f"[ERROR] Sending UDP packet: {e}")
+                next_burst = float("inf")  # Stop punching, as the threaded spammer did
+        timeout = None if next_burst == float("inf") else max(0.0, next_burst - monotonic())
+        for sel_key, _ in selector.select(timeout):
+            if sel_key.fileobj is sock:
+                try:
+                    dispatch(drain(fd), inboxes)
+                except ConnectionRefusedError:
+                    pass  # ICMP port-unreachable for an earlier burst; nothing was received
+                except OSError as e:
+                    print(f"[ERROR] Receiving message: {e}")
+            else:
+                # Raw read: sys.stdin's own buffer could hold lines select() never reports
+                chunk = os.read(stdin_fd, 4096)
+                if not chunk:
+                    # EOF; a last line without a newline is still sent
+                    if pending:
+                        send_chats(sock, [pending.decode(errors="replace").rstrip("\r")],
+                                   target_ip, chat_batch)
+                    return
+                *lines, pending = (pending + chunk).split(b"\n")
+                if lines:
+                    messages = [line.decode(errors="replace").rstrip("\r") for line in lines]
+                    if not send_chats(sock, messages, target_ip, chat_batch):
+                        return
+                    print("You: ", end="", flush=True)
 
 
 if __name__ == "__main__":
@@ -100,11 +427,34 @@ if __name__ == "__main__":
         exit(1)
     
     nat_type = detect_nat_type()
+    print(f"[CIPHER] {AEAD_NAME}")
+    if AEAD_NAME == "aesgcm" and not cpu_has_aes():
+        print("[CIPHER] No AES instructions on this CPU; P2P_AEAD=chacha20 on both peers is faster")
     
-    # Create a single UDP socket bound to the fixed port
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # Create a single UDP socket bound to the fixed port. The selectors loop wants it
+    # non-blocking; on Linux that is set in the socket() call itself (CLOEXEC is Python's default).
+    sock_type = socket.SOCK_DGRAM
+    if sys.platform != "win32":
+        sock_type |= getattr(socket, "SOCK_NONBLOCK", 0) | getattr(socket, "SOCK_CLOEXEC", 0)
+    sock = socket.socket(socket.AF_INET, sock_type)
     sock.bind(("", PORT))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+    # The kernel clamps to net.core.rmem_max/wmem_max, so report what was granted
+    print(f"[BUFFERS] recv {sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)} bytes, "
+          f"send {sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)} bytes")
+    if sys.platform.startswith("linux"):
+        # Let routers fragment instead of silently dropping packets over a smaller path MTU
+        sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DONT)
+    # Pin the socket to the peer: sends skip per-call address handling and the kernel
+    # drops datagrams from anyone else. Sending from this same socket keeps the source
+    # port the peer is punching towards.
+    sock.connect((target_ip, PORT))
     
-    threading.Thread(target=udp_listener, args=(sock,), daemon=True).start()
-    threading.Thread(target=udp_spammer, args=(sock, target_ip), daemon=True).start()
-    chat_sender(sock, target_ip)
+    if sys.platform == "win32":
+        # select() only takes sockets on Windows, so console input keeps its own thread
+        threading.Thread(target=udp_listener, args=(sock,), daemon=True).start()
+        threading.Thread(target=udp_spammer, args=(sock, target_ip), daemon=True).start()
+        chat_sender(sock, target_ip)
+    else:
+        event_loop(sock, target_ip)
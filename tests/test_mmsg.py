@@ -0,0 +1,109 @@
+import ctypes
+import importlib
+import select
+import socket
+import sys
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src' / 'p2p'))
+
+import mmsg
+
+
+def udp_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.setblocking(False)
+    return sock
+
+
+def wait_readable(sock, timeout=1.0):
+    select.select([sock], [], [], timeout)
+
+
+class StructLayoutTest(unittest.TestCase):
+    def test_sockaddr_in_matches_kernel_size(self):
+        self.assertEqual(ctypes.sizeof(mmsg.sockaddr_in), 16)
+
+    def test_msg_len_follows_msghdr(self):
+        self.assertEqual(mmsg.mmsghdr.msg_len.offset, ctypes.sizeof(mmsg.msghdr))
+
+
+class PlatformGateTest(unittest.TestCase):
+    def test_batches_disabled_outside_linux(self):
+        # The BSDs export sendmmsg/recvmmsg but with different struct layouts
+        try:
+            with mock.patch.object(sys, 'platform', 'freebsd14'):
+                bsd = importlib.reload(mmsg)
+                self.assertFalse(bsd.HAVE_SENDMMSG)
+                self.assertFalse(bsd.HAVE_RECVMMSG)
+                self.assertFalse(bsd.RecvBatch().supported)
+        finally:
+            importlib.reload(mmsg)
+
+
+@unittest.skipUnless(mmsg.HAVE_SENDMMSG and mmsg.HAVE_RECVMMSG, "sendmmsg/recvmmsg not available")
+class BatchRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.sender = udp_socket()
+        self.receivers = [udp_socket() for _ in range(3)]
+
+    def tearDown(self):
+        for sock in [self.sender] + self.receivers:
+            sock.close()
+
+    def test_send_to_ports_reaches_every_port(self):
+        ports = [sock.getsockname()[1] for sock in self.receivers]
+        sent = mmsg.SendBatch(8).send_to_ports(self.sender.fileno(), b'HB', '127.0.0.1', ports)
+        self.assertEqual(sent, len(ports))
+
+        for sock in self.receivers:
+            wait_readable(sock)
+            data, addr = sock.recvfrom(64)
+            self.assertEqual(data, b'HB')
+            self.assertEqual(addr, self.sender.getsockname())
+
+    def test_send_payloads_round_trip_through_recv_batch(self):
+        receiver = self.receivers[0]
+        payloads = [b'one', b'two', b'three']
+        sent = mmsg.SendBatch(4).send_payloads(self.sender.fileno(), payloads, receiver.getsockname())
+        self.assertEqual(sent, len(payloads))
+
+        wait_readable(receiver)
+        received = list(mmsg.RecvBatch(size=2).drain(receiver.fileno()))
+        self.assertEqual([data for data, _ in received], payloads)
+        self.assertTrue(all(addr == self.sender.getsockname() for _, addr in received))
+
+    def test_recv_on_empty_socket_does_not_block(self):
+        self.assertEqual(mmsg.RecvBatch().recv(self.receivers[0].fileno()), [])
+
+    def test_oversized_batch_is_rejected(self):
+        with self.assertRaises(ValueError):
+            mmsg.SendBatch(1).send_to_ports(self.sender.fileno(), b'HB', '127.0.0.1', [1, 2])
+
+
+class RecvFallbackTest(unittest.TestCase):
+    def test_drain_without_recvmmsg(self):
+        sender, receiver = udp_socket(), udp_socket()
+        try:
+            for payload in (b'a', b'b', b'c'):
+                sender.sendto(payload, receiver.getsockname())
+            wait_readable(receiver)
+
+            batch = mmsg.RecvBatch(size=2)
+            batch.supported = False
+            received = list(batch.drain(receiver.fileno()))
+            self.assertEqual([data for data, _ in received], [b'a', b'b', b'c'])
+            # Borrowing the fd for the fallback must not close it
+            sender.sendto(b'd', receiver.getsockname())
+            wait_readable(receiver)
+            self.assertEqual(receiver.recvfrom(8)[0], b'd')
+        finally:
+            sender.close()
+            receiver.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
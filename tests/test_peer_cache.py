@@ -0,0 +1,55 @@
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src' / 'p2p'))
+
+import client
+
+
+class PeerCacheTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        patcher = mock.patch.object(client, 'PEER_CACHE_PATH', self.path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(os.remove, self.path)
+
+    def write(self, content):
+        with open(self.path, 'w') as f:
+            json.dump(content, f)
+
+    def test_round_trip(self):
+        client.save_cached_peer('bob', ('203.0.113.7', 5000))
+        self.assertEqual(client.load_cached_peer('bob'), ('203.0.113.7', 5000))
+
+    def test_expired_entry_is_ignored(self):
+        self.write({'bob': {'ip': '203.0.113.7', 'port': 5000, 'expires': time.time() - 1}})
+        self.assertIsNone(client.load_cached_peer('bob'))
+
+    def test_wrong_shape_is_treated_as_empty(self):
+        for content in ([1, 2], 'text', {'bob': ['203.0.113.7', 5000]},
+                        {'bob': {'ip': '203.0.113.7', 'port': 5000}},
+                        {'bob': {'ip': None, 'port': '5000', 'expires': 'later'}}):
+            with self.subTest(content=content):
+                self.write(content)
+                self.assertIsNone(client.load_cached_peer('bob'))
+                client.save_cached_peer('alice', ('198.51.100.1', 4000))
+                self.assertEqual(client.load_cached_peer('alice'), ('198.51.100.1', 4000))
+
+    def test_save_keeps_valid_entries_and_drops_malformed_ones(self):
+        self.write({'bob': {'ip': '203.0.113.7', 'port': 5000, 'expires': time.time() + 60},
+                    'eve': {'expires': time.time() + 60}})
+        client.save_cached_peer('alice', ('198.51.100.1', 4000))
+        with open(self.path) as f:
+            self.assertEqual(set(json.load(f)), {'bob', 'alice'})
+
+
+if __name__ == '__main__':
+    unittest.main()
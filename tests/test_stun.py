@@ -0,0 +1,106 @@
+import contextlib
+import io
+import socket
+import struct
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src' / 'p2p'))
+
+import client
+
+TRANSACTION_ID = bytes(range(12))
+COOKIE = client.STUN_MAGIC_COOKIE.to_bytes(4, 'big')
+
+
+def attribute(attr_type, value):
+    """Encode one STUN attribute, padded to a 4-byte boundary"""
+    return struct.pack('!HH', attr_type, len(value)) + value + b'\0' * (-len(value) % 4)
+
+
+def address_value(ip, port, xor=False, family=0x01):
+    packed_ip = socket.inet_aton(ip)
+    if xor:
+        port ^= client.STUN_MAGIC_COOKIE >> 16
+        packed_ip = bytes(b ^ m for b, m in zip(packed_ip, COOKIE))
+    return struct.pack('!BBH', 0, family, port) + packed_ip
+
+
+def response(*attributes, msg_type=client.STUN_BINDING_SUCCESS):
+    body = b''.join(attributes)
+    return struct.pack('!HHI', msg_type, len(body), client.STUN_MAGIC_COOKIE) + TRANSACTION_ID + body
+
+
+class BuildRequestTest(unittest.TestCase):
+    def test_binding_request_header(self):
+        packet, transaction_id = client.build_stun_request()
+        self.assertEqual(len(packet), 20)
+        self.assertEqual(struct.unpack_from('!HHI', packet),
+                         (client.STUN_BINDING_REQUEST, 0, client.STUN_MAGIC_COOKIE))
+        self.assertEqual(packet[8:], transaction_id)
+
+
+class ParseResponseTest(unittest.TestCase):
+    def test_xor_mapped_address(self):
+        data = response(attribute(client.STUN_ATTR_XOR_MAPPED_ADDRESS,
+                                  address_value('203.0.113.7', 54321, xor=True)))
+        self.assertEqual(client.parse_stun_response(data), (TRANSACTION_ID, ('203.0.113.7', 54321)))
+
+    def test_skips_padded_unknown_attributes(self):
+        data = response(
+            attribute(0x8022, b'abc'),  # SOFTWARE, 3 bytes plus one byte of padding
+            attribute(client.STUN_ATTR_XOR_MAPPED_ADDRESS, address_value('198.51.100.1', 3478, xor=True))
+        )
+        self.assertEqual(client.parse_stun_response(data), (TRANSACTION_ID, ('198.51.100.1', 3478)))
+
+    def test_mapped_address_fallback(self):
+        data = response(attribute(client.STUN_ATTR_MAPPED_ADDRESS, address_value('192.0.2.10', 40000)))
+        self.assertEqual(client.parse_stun_response(data), (TRANSACTION_ID, ('192.0.2.10', 40000)))
+
+    def test_xor_mapped_address_wins_over_mapped_address(self):
+        data = response(
+            attribute(client.STUN_ATTR_MAPPED_ADDRESS, address_value('10.0.0.1', 1111)),
+            attribute(client.STUN_ATTR_XOR_MAPPED_ADDRESS, address_value('203.0.113.7', 2222, xor=True))
+        )
+        self.assertEqual(client.parse_stun_response(data), (TRANSACTION_ID, ('203.0.113.7', 2222)))
+
+    def test_ignores_ipv6_mappings(self):
+        value = struct.pack('!BBH', 0, 0x02, 1234) + bytes(16)
+        self.assertIsNone(client.parse_stun_response(response(attribute(client.STUN_ATTR_MAPPED_ADDRESS, value))))
+
+    def test_rejects_other_message_types(self):
+        data = response(attribute(client.STUN_ATTR_XOR_MAPPED_ADDRESS, address_value('203.0.113.7', 1, xor=True)),
+                        msg_type=0x0111)
+        self.assertIsNone(client.parse_stun_response(data))
+
+    def test_truncated_header(self):
+        self.assertIsNone(client.parse_stun_response(b''))
+        self.assertIsNone(client.parse_stun_response(response()[:19]))
+
+    def test_truncated_attribute(self):
+        data = response(attribute(client.STUN_ATTR_XOR_MAPPED_ADDRESS, address_value('203.0.113.7', 1, xor=True)))
+        self.assertIsNone(client.parse_stun_response(data[:-2]))
+
+    def test_attribute_length_past_end_of_message(self):
+        data = response(struct.pack('!HH', client.STUN_ATTR_MAPPED_ADDRESS, 64) + address_value('192.0.2.1', 1))
+        self.assertIsNone(client.parse_stun_response(data))
+
+
+class LateReplyTest(unittest.TestCase):
+    def test_stun_reply_after_quorum_is_not_printed_as_chat(self):
+        data = response(attribute(client.STUN_ATTR_XOR_MAPPED_ADDRESS, address_value('203.0.113.7', 1, xor=True)))
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            client.ChatProto().handle_message(data, ('127.0.0.1', 3478))
+        self.assertEqual(out.getvalue(), '')
+
+    def test_chat_text_is_still_printed(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            client.ChatProto().handle_message('hello there, how are you'.encode(), ('127.0.0.1', 5000))
+        self.assertIn('hello there, how are you', out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()